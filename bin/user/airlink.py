@@ -18,27 +18,60 @@
 WeeWX module that records AirLink air quality sensor readings.
 """
 
+import concurrent.futures
+import functools
+import itertools
+import json
 import logging
-import math
 import requests
 import sys
 import threading
 import time
 
+from bisect import bisect_left
 from dataclasses import dataclass
-from typing import Any, Dict, List, Tuple
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Tuple
 
 import weeutil.weeutil
 import weewx
 import weewx.units
 import weewx.xtypes
 
+from requests.adapters import HTTPAdapter
 from weewx.units import ValueTuple
 from weeutil.weeutil import timestamp_to_string
 from weeutil.weeutil import to_bool
 from weeutil.weeutil import to_int
 from weewx.engine import StdService
 
+# numpy is optional.  When available, AQI series are computed a whole column
+# at a time rather than row by row.
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# numba is optional (and only used with numpy).  When available, the AQI of a
+# series is computed by a compiled loop.
+try:
+    import numba
+except ImportError:
+    numba = None
+
+# fastjsonschema is optional.  When available, readings are checked by a
+# validator compiled once at import; is_type is only used to explain failures.
+try:
+    import fastjsonschema
+except ImportError:
+    fastjsonschema = None
+
+# orjson is optional.  When available, it is used to parse AirLink responses.
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = json.loads
+
 log = logging.getLogger(__name__)
 
 WEEWX_AIRLINK_VERSION = "1.4"
@@ -75,6 +108,16 @@ weewx.units.obs_group_dict['pm2_5_1m'] = 'group_concentration'
 weewx.units.obs_group_dict['pm2_5_1m_aqi'] = 'air_quality_index'
 weewx.units.obs_group_dict['pm2_5_1m_aqi_color'] = 'air_quality_color'
 
+# The unit registrations above (and those of the unit systems) don't change once
+# weewx is running, so the units of a (unit system, obs_type, aggregate_type) are
+# looked up once.
+_get_standard_unit_type = functools.lru_cache(maxsize=64)(weewx.units.getStandardUnitType)
+
+# Share one session across polls so that the HTTP connection to each AirLink
+# is kept alive rather than reopened (with a DNS lookup) every poll_interval.
+_session = requests.Session()
+_session.mount('http://', HTTPAdapter(pool_connections=4, pool_maxsize=4))
+
 class Source:
     def __init__(self, config_dict, name):
         # Raise KeyEror if name not in dictionary.
@@ -84,8 +127,7 @@ class Source:
         self.port = to_int(source_dict.get('port', 80))
         self.timeout  = to_int(source_dict.get('timeout', 10))
 
-@dataclass
-class Concentrations:
+class Concentrations(NamedTuple):
     timestamp     : float
     pm_1_last     : float
     pm_2p5_last   : float
@@ -98,132 +140,265 @@ class Concentrations:
     hum           : float
     temp          : float
 
+# The poller thread publishes each new reading by assigning a new Concentrations
+# object to Configuration.concentrations, which is a single atomic reference
+# store; Concentrations is an (immutable) NamedTuple.
+# Readers (e.g., fill_in_packet) therefore need no lock: they read the reference
+# once and use that object throughout.  At worst a reader sees the previous
+# reading, which is fine since readings older than archive_interval are ignored.
 @dataclass
 class Configuration:
-    lock            : threading.Lock
-    concentrations  : Concentrations # Controlled by lock
+    concentrations  : Concentrations # Replaced (never modified) by the poller
     archive_interval: int            # Immutable
     archive_delay   : int            # Immutable
     poll_interval   : int            # Immutable
     sources         : List[Source]   # Immutable
 
+# Queries the backup sources concurrently when the primary source fails.
+# Created on first use; the sources don't change once the service is running.
+_executor: Optional[concurrent.futures.ThreadPoolExecutor] = None
+# The latest request submitted to _executor for each backup source.
+_backup_futures: Dict[Source, concurrent.futures.Future] = {}
+
 def get_concentrations(cfg: Configuration):
-    for source in cfg.sources:
-        if source.enable:
-            record = collect_data(source.hostname,
-                                  source.port,
-                                  source.timeout,
-                                  cfg.archive_interval)
-            if record is not None:
-                log.debug('get_concentrations: source: %s' % record)
-                reading_ts = to_int(record['dateTime'])
-                age_of_reading = time.time() - reading_ts
-                if age_of_reading > cfg.archive_interval:
-                    log.info('Reading from %s:%d is old: %d seconds.' % (
-                        source.hostname, source.port, age_of_reading))
-                    continue
-                log.debug('get_concentrations: record: %s' % record)
-                concentrations = Concentrations(
-                    timestamp      = reading_ts,
-                    pm_1_last      = record['pm_1_last'],
-                    pm_2p5_last    = record['pm_2p5_last'],
-                    pm_10_last     = record['pm_10_last'],
-                    pm_1           = record['pm_1'],
-                    pm_2p5         = record['pm_2p5'],
-                    pm_10          = record['pm_10'],
-                    pm_2p5_nowcast = record['pm_2p5_nowcast'],
-                    pm_10_nowcast  = record['pm_10_nowcast'],
-                    hum            = record['hum'],
-                    temp           = record['temp'],
-                )
-                log.debug('get_concentrations: concentrations: %s' % concentrations)
+    sources = [source for source in cfg.sources if source.enable]
+    concentrations = None
+    if sources:
+        # The primary (lowest numbered) source is queried on its own; the
+        # backups are only contacted when it doesn't have a good reading.
+        concentrations = get_concentrations_from_source(sources[0], cfg.archive_interval)
+        if concentrations is None and len(sources) > 1:
+            concentrations = get_concentrations_from_backups(sources[1:], cfg.archive_interval)
+    if concentrations is None:
+        log.error('Could not get concentrations from any source.')
+    return concentrations
+
+def get_concentrations_from_backups(sources: List[Source], archive_interval: int) -> Optional[Concentrations]:
+    """Query the backup sources at once, rather than waiting on each in turn (for
+    as long as its timeout if it's down).  The reading of the first one (in
+    configured order) with a good reading is used."""
+    global _executor
+    if len(sources) == 1:
+        return get_concentrations_from_source(sources[0], archive_interval)
+    if _executor is None:
+        _executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=len(sources), thread_name_prefix='AirLink')
+    futures = []
+    for source in sources:
+        future = _backup_futures.get(source)
+        if future is None or future.done():
+            future = _executor.submit(get_concentrations_from_source, source, archive_interval)
+            _backup_futures[source] = future
+        else:
+            # Still waiting on the device from an earlier poll; don't pile
+            # another request up behind that one.
+            log.debug('get_concentrations: %s:%d has not answered an earlier request.',
+                      source.hostname, source.port)
+        futures.append(future)
+    try:
+        for future in futures:
+            concentrations = future.result()
+            if concentrations is not None:
                 return concentrations
-    log.error('Could not get concentrations from any source.')
-    return None
+        return None
+    finally:
+        # Requests to lower priority sources that haven't started are no longer needed.
+        for future in futures:
+            future.cancel()
+
+def _shutdown_executor() -> None:
+    global _executor
+    if _executor is not None:
+        for future in _backup_futures.values():
+            future.cancel()
+        _backup_futures.clear()
+        _executor.shutdown(wait=False)
+        _executor = None
+
+def get_concentrations_from_source(source: Source, archive_interval: int) -> Optional[Concentrations]:
+    record = collect_data(source.hostname,
+                          source.port,
+                          source.timeout,
+                          archive_interval)
+    if record is None:
+        return None
+    log.debug('get_concentrations: source: %s', record)
+    reading_ts = to_int(record['dateTime'])
+    age_of_reading = time.time() - reading_ts
+    if age_of_reading > archive_interval:
+        log.info('Reading from %s:%d is old: %d seconds.' % (
+            source.hostname, source.port, age_of_reading))
+        return None
+    log.debug('get_concentrations: record: %s', record)
+    concentrations = Concentrations(
+        timestamp      = reading_ts,
+        pm_1_last      = record['pm_1_last'],
+        pm_2p5_last    = record['pm_2p5_last'],
+        pm_10_last     = record['pm_10_last'],
+        pm_1           = record['pm_1'],
+        pm_2p5         = record['pm_2p5'],
+        pm_10          = record['pm_10'],
+        pm_2p5_nowcast = record['pm_2p5_nowcast'],
+        pm_10_nowcast  = record['pm_10_nowcast'],
+        hum            = record['hum'],
+        temp           = record['temp'],
+    )
+    log.debug('get_concentrations: concentrations: %s', concentrations)
+    return concentrations
+
+_MISSING = object()
 
 def is_type(j: Dict[str, Any], t, name: str, none_ok: bool = False) -> bool:
-    try:
-        x = j[name]
-        if x is None and none_ok:
-            return True
-        if not isinstance(x, t):
-            log.debug('%s is not an instance of %s: %s' % (name, t, j[name]))
-            return False
-        return True
-    except KeyError as e:
-        log.debug('is_type: could not find key: %s' % e)
+    x = j.get(name, _MISSING)
+    if x is _MISSING:
+        log.debug('is_type: could not find key: %s', name)
         return False
-    except Exception as e:
-        log.debug('is_type: exception: %s' % e)
+    if x is None and none_ok:
+        return True
+    # JSON true and false are not numbers, though Python's bool is an int.
+    if isinstance(x, bool) or not isinstance(x, t):
+        log.debug('%s is not an instance of %s: %s', name, t, x)
         return False
+    return True
+
+_INT_FIELDS = ('pm_1_last', 'pm_2p5_last', 'pm_10_last', 'last_report_time',
+               'pct_pm_data_last_1_hour', 'pct_pm_data_last_3_hours',
+               'pct_pm_data_nowcast', 'pct_pm_data_last_24_hours')
+_FLOAT_FIELDS = ('temp', 'hum', 'dew_point', 'wet_bulb', 'heat_index')
+_NULLABLE_FLOAT_FIELDS = ('pm_1', 'pm_2p5', 'pm_2p5_last_1_hour',
+                          'pm_2p5_last_3_hours', 'pm_2p5_last_24_hours', 'pm_2p5_nowcast',
+                          'pm_10', 'pm_10_last_1_hour', 'pm_10_last_3_hours',
+                          'pm_10_last_24_hours', 'pm_10_nowcast')
+
+# JSON schema equivalent to the checks in is_sane.
+_CONDITIONS_SCHEMA: Dict[str, Any] = {
+    'type': 'object',
+    'required': ['data_structure_type', 'lsid'] + list(_INT_FIELDS + _FLOAT_FIELDS + _NULLABLE_FLOAT_FIELDS),
+    'properties': {
+        'data_structure_type': {'type': 'integer', 'enum': [6]},
+        'lsid': {'type': ['integer', 'null']},
+        **{name: {'type': ['integer', 'null']} for name in _INT_FIELDS},
+        **{name: {'type': 'number'} for name in _FLOAT_FIELDS},
+        **{name: {'type': ['number', 'null']} for name in _NULLABLE_FLOAT_FIELDS},
+    },
+}
+_SANITY_SCHEMA: Dict[str, Any] = {
+    # Unlike later drafts, draft-04 doesn't accept 1.0 as an integer, which
+    # matches is_type's isinstance(x, int).
+    '$schema': 'http://json-schema.org/draft-04/schema#',
+    'type': 'object',
+    'required': ['data', 'error'],
+    'properties': {
+        'error': {'type': 'null'},
+        'data': {
+            'type': 'object',
+            'required': ['name', 'ts', 'conditions'],
+            'properties': {
+                'name': {'type': 'string'},
+                'ts': {'type': 'integer'},
+                'conditions': {
+                    'type': 'array',
+                    'minItems': 1,
+                    'items': [_CONDITIONS_SCHEMA],
+                },
+            },
+        },
+    },
+}
+
+_validate_sanity = fastjsonschema.compile(_SANITY_SCHEMA) if fastjsonschema is not None else None
+
+# (type 6 name, type 5 name) of the fields renamed between data structure types 5 and 6.
+_TYPE_5_TO_6_RENAMES = (
+    ('pm_10',               'pm_10p0'),
+    ('pm_10_last_1_hour',   'pm_10p0_last_1_hour'),
+    ('pm_10_last_3_hours',  'pm_10p0_last_3_hours'),
+    ('pm_10_last_24_hours', 'pm_10p0_last_24_hours'),
+    ('pm_10_nowcast',       'pm_10p0_nowcast'),
+)
 
 def convert_data_structure_type_5_to_6(j: Dict[str, Any]) -> None:
     # Fix up these names and change data_structure_type to 6
     try:
-        j['data']['conditions'][0]['pm_10'] = j['data']['conditions'][0]['pm_10p0']
-        j['data']['conditions'][0]['pm_10p0'] = None
-        j['data']['conditions'][0]['pm_10_last_1_hour'] = j['data']['conditions'][0]['pm_10p0_last_1_hour']
-        j['data']['conditions'][0]['pm_10p0_last_1_hour'] = None
-        j['data']['conditions'][0]['pm_10_last_3_hours'] = j['data']['conditions'][0]['pm_10p0_last_3_hours']
-        j['data']['conditions'][0]['pm_10p0_last_3_hours'] = None
-        j['data']['conditions'][0]['pm_10_last_24_hours'] = j['data']['conditions'][0]['pm_10p0_last_24_hours']
-        j['data']['conditions'][0]['pm_10p0_last_24_hours'] = None
-        j['data']['conditions'][0]['pm_10_nowcast'] = j['data']['conditions'][0]['pm_10p0_nowcast']
-        j['data']['conditions'][0]['pm_10p0_nowcast'] = None
-
-        j['data']['conditions'][0]['data_structure_type'] = 6
+        c = j['data']['conditions'][0]
+        for new_name, old_name in _TYPE_5_TO_6_RENAMES:
+            c[new_name] = c.pop(old_name)
+
+        c['data_structure_type'] = 6
         log.debug('Converted type 5 record to type 6.')
     except Exception as e:
         log.info('convert_data_structure_type_5_to_6: exception: %s' % e)
         # Let sanity check handle the issue.
 
 def is_sane(j: Dict[str, Any]) -> Tuple[bool, str]:
+    schema_msg = None
+    if _validate_sanity is not None:
+        try:
+            _validate_sanity(j)
+            return True, ''
+        except fastjsonschema.JsonSchemaException as e:
+            schema_msg = e.message
+            log.debug('is_sane: %s', schema_msg)
+            # Fall through to find out which field is at fault.
+
     if j['error'] is not None:
         return False, 'Error: %s' % j['error']
 
     if not is_type(j, dict, 'data'):
         return False, 'Missing or malformed "data" field'
+    data = j['data']
 
-    if not is_type(j['data'], str, 'name'):
+    if not is_type(data, str, 'name'):
         return False, 'Missing or malformed "name" field'
 
-    if not is_type(j['data'], int, 'ts'):
+    if not is_type(data, int, 'ts'):
         return False, 'Missing or malformed "ts" field'
 
-    if not is_type(j['data'], list, 'conditions'):
+    if not is_type(data, list, 'conditions'):
         return False, 'Missing or malformed "conditions" field'
+    conditions = data['conditions']
 
-    if len(j['data']['conditions']) == 0:
+    if len(conditions) == 0:
         return False, 'Expected one element in conditions array.'
+    c = conditions[0]
 
-    if not is_type(j['data']['conditions'][0], int, 'data_structure_type'):
+    if not isinstance(c, dict) or not is_type(c, int, 'data_structure_type'):
         return False, 'Missing or malformed "data_structure_type" field'
 
-    if j['data']['conditions'][0]['data_structure_type'] != 6:
+    if c['data_structure_type'] != 6:
         return False, 'Expected data_structure_type of 6 (or type 5 auto converted to 6.'
 
-    for name in ['pm_1_last', 'pm_2p5_last', 'pm_10_last', 'last_report_time',
-            'pct_pm_data_last_1_hour', 'pct_pm_data_last_3_hours',
-            'pct_pm_data_nowcast', 'pct_pm_data_last_24_hours']:
-        if not is_type(j['data']['conditions'][0], int, name, True):
+    for name in _INT_FIELDS:
+        if not is_type(c, int, name, True):
             return False, 'Missing or malformed "%s" field' % name
 
-    if not is_type(j['data']['conditions'][0], int, 'lsid', True):
+    if not is_type(c, int, 'lsid', True):
         return False, 'Missing or malformed "lsid" field'
 
-    for name in ['temp', 'hum', 'dew_point', 'wet_bulb', 'heat_index']:
-        if not is_type(j['data']['conditions'][0], float, name):
+    for name in _FLOAT_FIELDS:
+        if not is_type(c, (int, float), name):
             return False, 'Missing or malformed "%s" field' % name
 
-    for name in ['pm_1', 'pm_2p5', 'pm_2p5_last_1_hour',
-             'pm_2p5_last_3_hours', 'pm_2p5_last_24_hours', 'pm_2p5_nowcast',
-             'pm_10', 'pm_10_last_1_hour', 'pm_10_last_3_hours',
-             'pm_10_last_24_hours', 'pm_10_nowcast']:
-        if not is_type(j['data']['conditions'][0], float, name, True):
+    for name in _NULLABLE_FLOAT_FIELDS:
+        if not is_type(c, (int, float), name, True):
             return False, 'Missing or malformed "%s" field' % name
 
+    # The checks above are meant to find whatever the schema objected to.  If
+    # they don't, the reading is still rejected, with the validator's message.
+    if schema_msg is not None:
+        return False, schema_msg
+
     return True, ''
 
+class CachedResponse(NamedTuple):
+    headers: Dict[str, str] # Conditional request headers (If-None-Match, If-Modified-Since)
+    j      : Dict[str, Any] # The parsed and sanity checked reading
+
+# The last reading from each url whose response carried an ETag or Last-Modified
+# header.  If the device answers a conditional GET with 304 Not Modified, the
+# cached reading is used rather than downloading and parsing it again.
+_conditional_get_cache: Dict[str, CachedResponse] = {}
+
 def collect_data(hostname, port, timeout, archive_interval):
 
     j = None
@@ -231,14 +406,19 @@ def collect_data(hostname, port, timeout, archive_interval):
 
     try:
         # fetch data
-        log.debug('collect_data: fetching from url: %s, timeout: %d' % (url, timeout))
-        r = requests.get(url=url, timeout=timeout)
+        log.debug('collect_data: fetching from url: %s, timeout: %d', url, timeout)
+        cached = _conditional_get_cache.get(url)
+        r = _session.get(url, headers=cached.headers if cached else None, timeout=timeout)
         r.raise_for_status()
-        log.debug('collect_data: %s returned %r' % (hostname, r))
-        if r:
+        log.debug('collect_data: %s returned %r', hostname, r)
+        if r.status_code == 304 and cached is not None:
+            # Not modified since the last reading, which was already parsed and checked.
+            log.debug('collect_data: %s reading not modified.', hostname)
+            j = cached.j
+        else:
             # convert to json
-            j = r.json()
-            log.debug('collect_data: json returned from %s is: %r' % (hostname, j))
+            j = _json_loads(r.content)
+            log.debug('collect_data: json returned from %s is: %r', hostname, j)
             # Check for error
             if 'error' in j and j['error'] is not None:
                 error = j['error']
@@ -254,36 +434,44 @@ def collect_data(hostname, port, timeout, archive_interval):
             if not sane:
                 log.info('Reading not sane:  %s (%s)' % (msg, j))
                 return None
-            time_of_reading = j['data']['conditions'][0]['last_report_time']
-            # The reading could be old.
-            # Check that it's not older than now - arcint
-            age_of_reading = time.time() - time_of_reading
-            if age_of_reading > archive_interval:
-                # Perhaps the AirLink has rebooted.  If so, the last_report_time
-                # will be seconds from boot time (until the device syncs
-                # time.  Check for this by checking if concentrations.pm_1
-                # is None.
-                if j['data']['conditions'][0]['pm_1'] is None:
-                    log.info('last_report_time must be time since boot: %d seconds.  Record: %s'
-                             % (time_of_reading, j))
-                else:
-                    # Not current.  (Note: Rarely, spurious timestamps (e.g., 2016 in 2020)
-                    # have been observed.  Both the ts and last_report_time fields are incorrect.
-                    # Example on Oct 10 21:11:38:
-                    # {'data': {'did': '001D0A100214', 'name': 'airlink', 'ts': 1461926887,
-                    # 'conditions': [{'lsid': 349506, 'data_structure_type': 6, 'temp': 67.7,
-                    # 'hum': 72.2, 'dew_point': 58.4, 'wet_bulb': 61.2, 'heat_index': 68.1,
-                    # 'pm_1_last': 0, 'pm_2p5_last': 0, 'pm_10_last': 0, 'pm_1': 0.0,
-                    # 'pm_2p5': 0.0, 'pm_2p5_last_1_hour': 0.13, 'pm_2p5_last_3_hours': 0.27,
-                    # 'pm_2p5_last_24_hours': 0.43, 'pm_2p5_nowcast': 0.23, 'pm_10': 1.09,
-                    # 'pm_10_last_1_hour': 0.64, 'pm_10_last_3_hours': 0.89,
-                    # 'pm_10_last_24_hours': 1.02, 'pm_10_nowcast': 0.84,
-                    # 'last_report_time': 1461926886, 'pct_pm_data_last_1_hour': 100,
-                    # 'pct_pm_data_last_3_hours': 100, 'pct_pm_data_nowcast': 100,
-                    # 'pct_pm_data_last_24_hours': 100}]}, 'error': None}
-                    log.info('Ignoring reading from %s--age: %d seconds.  Record: %s'
-                             % (hostname, age_of_reading, j))
-                j = None
+            # If the device supplied validators, make the next request conditional.
+            headers = {}
+            if 'ETag' in r.headers:
+                headers['If-None-Match'] = r.headers['ETag']
+            if 'Last-Modified' in r.headers:
+                headers['If-Modified-Since'] = r.headers['Last-Modified']
+            if headers:
+                _conditional_get_cache[url] = CachedResponse(headers, j)
+        time_of_reading = j['data']['conditions'][0]['last_report_time']
+        # The reading could be old.
+        # Check that it's not older than now - arcint
+        age_of_reading = time.time() - time_of_reading
+        if age_of_reading > archive_interval:
+            # Perhaps the AirLink has rebooted.  If so, the last_report_time
+            # will be seconds from boot time (until the device syncs
+            # time.  Check for this by checking if concentrations.pm_1
+            # is None.
+            if j['data']['conditions'][0]['pm_1'] is None:
+                log.info('last_report_time must be time since boot: %d seconds.  Record: %s'
+                         % (time_of_reading, j))
+            else:
+                # Not current.  (Note: Rarely, spurious timestamps (e.g., 2016 in 2020)
+                # have been observed.  Both the ts and last_report_time fields are incorrect.
+                # Example on Oct 10 21:11:38:
+                # {'data': {'did': '001D0A100214', 'name': 'airlink', 'ts': 1461926887,
+                # 'conditions': [{'lsid': 349506, 'data_structure_type': 6, 'temp': 67.7,
+                # 'hum': 72.2, 'dew_point': 58.4, 'wet_bulb': 61.2, 'heat_index': 68.1,
+                # 'pm_1_last': 0, 'pm_2p5_last': 0, 'pm_10_last': 0, 'pm_1': 0.0,
+                # 'pm_2p5': 0.0, 'pm_2p5_last_1_hour': 0.13, 'pm_2p5_last_3_hours': 0.27,
+                # 'pm_2p5_last_24_hours': 0.43, 'pm_2p5_nowcast': 0.23, 'pm_10': 1.09,
+                # 'pm_10_last_1_hour': 0.64, 'pm_10_last_3_hours': 0.89,
+                # 'pm_10_last_24_hours': 1.02, 'pm_10_nowcast': 0.84,
+                # 'last_report_time': 1461926886, 'pct_pm_data_last_1_hour': 100,
+                # 'pct_pm_data_last_3_hours': 100, 'pct_pm_data_nowcast': 100,
+                # 'pct_pm_data_last_24_hours': 100}]}, 'error': None}
+                log.info('Ignoring reading from %s--age: %d seconds.  Record: %s'
+                         % (hostname, age_of_reading, j))
+            j = None
     except Exception as e:
         log.info('collect_data: Attempt to fetch from: %s failed: %s.' % (hostname, e))
         j = None
@@ -293,56 +481,58 @@ def collect_data(hostname, port, timeout, archive_interval):
         return None
 
     # create a record
-    log.debug('Successful read from %s.' % hostname)
+    log.debug('Successful read from %s.', hostname)
     return populate_record(time_of_reading, j)
 
-def populate_record(ts, j):
-    record = dict()
-    record['dateTime'] = ts
-    record['usUnits'] = weewx.US
-
-    # put items into record
-    missed = []
-
-    def get_and_update_missed(key):
-        if key in j['data']['conditions'][0]:
-            return j['data']['conditions'][0][key]
-        else:
-            missed.append(key)
-            return None
+# Fields of conditions[0] that populate_record copies into the record.
+_EXPECTED_KEYS = (
+    'last_report_time', 'temp', 'hum', 'dew_point', 'wet_bulb', 'heat_index',
+    'pct_pm_data_last_1_hour', 'pct_pm_data_last_3_hours',
+    'pct_pm_data_nowcast', 'pct_pm_data_last_24_hours',
+    'pm_1_last', 'pm_2p5_last', 'pm_10_last', 'pm_1',
+    'pm_2p5', 'pm_2p5_last_1_hour', 'pm_2p5_last_3_hours',
+    'pm_2p5_last_24_hours', 'pm_2p5_nowcast',
+    'pm_10', 'pm_10_last_1_hour', 'pm_10_last_3_hours',
+    'pm_10_last_24_hours', 'pm_10_nowcast')
 
-    record['last_report_time'] = get_and_update_missed('last_report_time')
-    record['temp'] = get_and_update_missed('temp')
-    record['hum'] = get_and_update_missed('hum')
-    record['dew_point'] = get_and_update_missed('dew_point')
-    record['wet_bulb'] = get_and_update_missed('wet_bulb')
-    record['heat_index'] = get_and_update_missed('heat_index')
-    record['pct_pm_data_last_1_hour'] = get_and_update_missed('pct_pm_data_last_1_hour')
-    record['pct_pm_data_last_3_hours'] = get_and_update_missed('pct_pm_data_last_3_hours')
-    record['pct_pm_data_nowcast'] = get_and_update_missed('pct_pm_data_nowcast')
-    record['pct_pm_data_last_24_hours'] = get_and_update_missed('pct_pm_data_last_24_hours')
-
-    record['pm1_0'] = get_and_update_missed('pm_1_last')
-    record['pm2_5'] = get_and_update_missed('pm_2p5_last')
-    record['pm10_0'] = get_and_update_missed('pm_10_last')
-
-    # Copy in all of the concentrations.
-    record['pm_1'] = get_and_update_missed('pm_1')
-    record['pm_1_last'] = get_and_update_missed('pm_1_last')
-    for prefix in ['pm_2p5', 'pm_10']:
-        key = prefix + '_last'
-        record[key] = get_and_update_missed(key)
-        key = prefix
-        record[key] = get_and_update_missed(key)
-        key = prefix + '_last_1_hour'
-        record[key] = get_and_update_missed(key)
-        key = prefix + '_last_3_hours'
-        record[key] = get_and_update_missed(key)
-        key = prefix + '_last_24_hours'
-        record[key] = get_and_update_missed(key)
-        key = prefix + '_nowcast'
-        record[key] = get_and_update_missed(key)
+def populate_record(ts, j):
+    c = j['data']['conditions'][0]
+    record = {
+        'dateTime'                 : ts,
+        'usUnits'                  : weewx.US,
+        'last_report_time'         : c.get('last_report_time'),
+        'temp'                     : c.get('temp'),
+        'hum'                      : c.get('hum'),
+        'dew_point'                : c.get('dew_point'),
+        'wet_bulb'                 : c.get('wet_bulb'),
+        'heat_index'               : c.get('heat_index'),
+        'pct_pm_data_last_1_hour'  : c.get('pct_pm_data_last_1_hour'),
+        'pct_pm_data_last_3_hours' : c.get('pct_pm_data_last_3_hours'),
+        'pct_pm_data_nowcast'      : c.get('pct_pm_data_nowcast'),
+        'pct_pm_data_last_24_hours': c.get('pct_pm_data_last_24_hours'),
+
+        'pm1_0'                    : c.get('pm_1_last'),
+        'pm2_5'                    : c.get('pm_2p5_last'),
+        'pm10_0'                   : c.get('pm_10_last'),
+
+        # Copy in all of the concentrations.
+        'pm_1'                     : c.get('pm_1'),
+        'pm_1_last'                : c.get('pm_1_last'),
+        'pm_2p5_last'              : c.get('pm_2p5_last'),
+        'pm_2p5'                   : c.get('pm_2p5'),
+        'pm_2p5_last_1_hour'       : c.get('pm_2p5_last_1_hour'),
+        'pm_2p5_last_3_hours'      : c.get('pm_2p5_last_3_hours'),
+        'pm_2p5_last_24_hours'     : c.get('pm_2p5_last_24_hours'),
+        'pm_2p5_nowcast'           : c.get('pm_2p5_nowcast'),
+        'pm_10_last'               : c.get('pm_10_last'),
+        'pm_10'                    : c.get('pm_10'),
+        'pm_10_last_1_hour'        : c.get('pm_10_last_1_hour'),
+        'pm_10_last_3_hours'       : c.get('pm_10_last_3_hours'),
+        'pm_10_last_24_hours'      : c.get('pm_10_last_24_hours'),
+        'pm_10_nowcast'            : c.get('pm_10_nowcast'),
+    }
 
+    missed = [key for key in _EXPECTED_KEYS if key not in c]
     if missed:
         log.info("Sensor didn't report field(s): %s" % ','.join(missed))
 
@@ -359,14 +549,13 @@ class AirLink(StdService):
         self.config_dict = config_dict.get('AirLink', {})
 
         self.cfg = Configuration(
-            lock             = threading.Lock(),
             concentrations   = None,
             archive_interval = int(config_dict['StdArchive']['archive_interval']),
             archive_delay    = to_int(config_dict['StdArchive'].get('archive_delay', 15)),
             poll_interval    = 5,
             sources          = AirLink.configure_sources(self.config_dict))
-        with self.cfg.lock:
-            self.cfg.concentrations = get_concentrations(self.cfg)
+        self.cfg.concentrations = get_concentrations(self.cfg)
+        self.aqi = None
 
         source_count = 0
         for source in self.cfg.sources:
@@ -378,7 +567,9 @@ class AirLink(StdService):
         if source_count == 0:
             log.error('No sources configured for airlink extension.  AirLink extension is inoperable.')
         else:
-            weewx.xtypes.xtypes.append(AQI())
+            # A cached aggregate is at most one archive period old.
+            self.aqi = AQI(self.cfg.archive_interval)
+            weewx.xtypes.xtypes.append(self.aqi)
 
             # Start a thread to query devices.
             dp: DevicePoller = DevicePoller(self.cfg)
@@ -388,77 +579,111 @@ class AirLink(StdService):
             t.start()
 
             self.bind(weewx.NEW_LOOP_PACKET, self.new_loop_packet)
+            self.bind(weewx.NEW_ARCHIVE_RECORD, self.new_archive_record)
 
     def new_loop_packet(self, event):
-        log.debug('new_loop_packet(%s)' % event)
+        log.debug('new_loop_packet(%s)', event)
         AirLink.fill_in_packet(self.cfg, event.packet)
 
+    def new_archive_record(self, event):
+        # The new record may fall within cached aggregates' timespans.
+        if self.aqi is not None:
+            self.aqi.clear_cache()
+
+    def shutDown(self):
+        # Remove the xtype so that an engine restart doesn't register it twice,
+        # and drop the memoized AQI values along with it.
+        if self.aqi is not None:
+            try:
+                weewx.xtypes.xtypes.remove(self.aqi)
+            except ValueError:
+                pass
+            self.aqi = None
+        _compute_pm2_5_aqi_tenths.cache_clear()
+        # Don't start any more requests to backup sources.
+        _shutdown_executor()
+
     @staticmethod
     def fill_in_packet(cfg: Configuration, packet: Dict):
-        with cfg.lock:
-            log.debug('new_loop_packet: cfg.concentrations: %s' % cfg.concentrations)
-            if cfg.concentrations is not None and \
-                    cfg.concentrations.timestamp is not None and \
-                    cfg.concentrations.timestamp + \
-                    cfg.archive_interval >= time.time():
-                log.debug('Time of reading being inserted: %s' % timestamp_to_string(cfg.concentrations.timestamp))
-                # Insert pm1_0, pm2_5, pm10_0, aqi and aqic into loop packet.
-                if cfg.concentrations.pm_1_last is not None:
-                    packet['pm1_0'] = cfg.concentrations.pm_1_last
-                    log.debug('Inserted packet[pm1_0]: %f into packet.' % cfg.concentrations.pm_1_last)
-                if cfg.concentrations.pm_2p5_last is not None:
-                    packet['pm2_5'] = cfg.concentrations.pm_2p5_last
-                    log.debug('Inserted packet[pm2_5]: %f into packet.' % cfg.concentrations.pm_2p5_last)
-                    # Put aqi and color in the packet.
-                    packet['pm2_5_aqi'] = AQI.compute_pm2_5_aqi(packet['pm2_5'])
-                    packet['pm2_5_aqi_color'] = AQI.compute_pm2_5_aqi_color(packet['pm2_5_aqi'])
-                if cfg.concentrations.pm_10_last is not None:
-                    packet['pm10_0'] = cfg.concentrations.pm_10_last
-                    log.debug('Inserted packet[pm10_0]: %f into packet.' % cfg.concentrations.pm_10_last)
-
-                # Also insert one minute averages as these averages are more useful for showing in realtime.
-                # If 1m averages are not available, use last instead.
-                if cfg.concentrations.pm_1 is not None:
-                    packet['pm1_0_1m']       = cfg.concentrations.pm_1
-                elif cfg.concentrations.pm_1_last is not None:
-                    packet['pm1_0_1m']       = cfg.concentrations.pm_1_last
-                if cfg.concentrations.pm_2p5 is not None:
-                    packet['pm2_5_1m']       = cfg.concentrations.pm_2p5
-                elif cfg.concentrations.pm_2p5_last is not None:
-                    packet['pm2_5_1m']       = cfg.concentrations.pm_2p5_last
-                if cfg.concentrations.pm_10 is not None:
-                    packet['pm10_0_1m']      = cfg.concentrations.pm_10
-                elif cfg.concentrations.pm_10_last is not None:
-                    packet['pm10_0_1m']      = cfg.concentrations.pm_10_last
-
-                # Add 1m aqi and color
-                if 'pm2_5_1m' in packet:
-                    packet['pm2_5_1m_aqi'] = AQI.compute_pm2_5_aqi(packet['pm2_5_1m'])
-                    packet['pm2_5_1m_aqi_color'] = AQI.compute_pm2_5_aqi_color(packet['pm2_5_1m_aqi'])
-
-                # And insert nowcast for pm 2.5 and 10 as some might want to report that.
-                # If nowcast not available, don't substitute.
-                if cfg.concentrations.pm_2p5_nowcast is not None:
-                    packet['pm2_5_nowcast']  = cfg.concentrations.pm_2p5_nowcast
-                    packet['pm2_5_nowcast_aqi'] = AQI.compute_pm2_5_aqi(packet['pm2_5_nowcast'])
-                    packet['pm2_5_nowcast_aqi_color'] = AQI.compute_pm2_5_aqi_color(packet['pm2_5_nowcast_aqi'])
-                if cfg.concentrations.pm_10_nowcast is not None:
-                    packet['pm10_0_nowcast'] = cfg.concentrations.pm_10_nowcast
-            else:
-                log.error('Found no concentrations to insert.')
+        # Read the reference once; see the comment on Configuration.
+        concentrations = cfg.concentrations
+        log.debug('new_loop_packet: cfg.concentrations: %s', concentrations)
+        if concentrations is None or \
+                concentrations.timestamp is None or \
+                concentrations.timestamp + cfg.archive_interval < time.time():
+            log.error('Found no concentrations to insert.')
+            return
+
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug('Time of reading being inserted: %s', timestamp_to_string(concentrations.timestamp))
+        pm1_0_last     = concentrations.pm_1_last
+        pm2_5_last     = concentrations.pm_2p5_last
+        pm10_0_last    = concentrations.pm_10_last
+        pm1_0_1m       = concentrations.pm_1
+        pm2_5_1m       = concentrations.pm_2p5
+        pm10_0_1m      = concentrations.pm_10
+        pm2_5_nowcast  = concentrations.pm_2p5_nowcast
+        pm10_0_nowcast = concentrations.pm_10_nowcast
+
+        # Collect the fields and insert them into the packet in one update.
+        fields: Dict[str, Any] = {}
+
+        # Insert pm1_0, pm2_5, pm10_0, aqi and aqic into loop packet.
+        if pm1_0_last is not None:
+            fields['pm1_0'] = pm1_0_last
+        if pm2_5_last is not None:
+            fields['pm2_5'] = pm2_5_last
+            # Put aqi and color in the packet.
+            pm2_5_aqi = AQI.compute_pm2_5_aqi(pm2_5_last)
+            pm2_5_aqi_color = AQI.compute_pm2_5_aqi_color(pm2_5_aqi)
+            fields['pm2_5_aqi'] = pm2_5_aqi
+            fields['pm2_5_aqi_color'] = pm2_5_aqi_color
+        if pm10_0_last is not None:
+            fields['pm10_0'] = pm10_0_last
+
+        # Also insert one minute averages as these averages are more useful for showing in realtime.
+        # If 1m averages are not available, use last instead.
+        # Also add 1m aqi and color.
+        if pm1_0_1m is not None:
+            fields['pm1_0_1m'] = pm1_0_1m
+        elif pm1_0_last is not None:
+            fields['pm1_0_1m'] = pm1_0_last
+        if pm2_5_1m is not None:
+            fields['pm2_5_1m'] = pm2_5_1m
+            pm2_5_1m_aqi = AQI.compute_pm2_5_aqi(pm2_5_1m)
+            fields['pm2_5_1m_aqi'] = pm2_5_1m_aqi
+            fields['pm2_5_1m_aqi_color'] = AQI.compute_pm2_5_aqi_color(pm2_5_1m_aqi)
+        elif pm2_5_last is not None:
+            fields['pm2_5_1m'] = pm2_5_last
+            # Same concentration as pm2_5, so its aqi and color apply.
+            fields['pm2_5_1m_aqi'] = pm2_5_aqi
+            fields['pm2_5_1m_aqi_color'] = pm2_5_aqi_color
+        if pm10_0_1m is not None:
+            fields['pm10_0_1m'] = pm10_0_1m
+        elif pm10_0_last is not None:
+            fields['pm10_0_1m'] = pm10_0_last
+
+        # And insert nowcast for pm 2.5 and 10 as some might want to report that.
+        # If nowcast not available, don't substitute.
+        if pm2_5_nowcast is not None:
+            fields['pm2_5_nowcast'] = pm2_5_nowcast
+            pm2_5_nowcast_aqi = AQI.compute_pm2_5_aqi(pm2_5_nowcast)
+            fields['pm2_5_nowcast_aqi'] = pm2_5_nowcast_aqi
+            fields['pm2_5_nowcast_aqi_color'] = AQI.compute_pm2_5_aqi_color(pm2_5_nowcast_aqi)
+        if pm10_0_nowcast is not None:
+            fields['pm10_0_nowcast'] = pm10_0_nowcast
+
+        packet.update(fields)
+        log.debug('Inserted into packet: %s', fields)
 
+    @staticmethod
     def configure_sources(config_dict):
-        sources = []
-        idx = 0
-        while True:
-            idx += 1
-            try:
-                source = Source(config_dict, 'Sensor%d' % idx)
-                sources.append(source)
-            except KeyError:
-                break
-
-        return sources
+        # Sensor sections are interrogated in numeric order; gaps in the
+        # numbering (e.g., Sensor1, Sensor3) are allowed.
+        names = sorted((k for k in config_dict
+                        if k.startswith('Sensor') and k[6:].isdigit()),
+                       key=lambda k: int(k[6:]))
+        return [Source(config_dict, name) for name in names]
 
 class DevicePoller:
     def __init__(self, cfg: Configuration):
@@ -466,6 +691,11 @@ class DevicePoller:
 
     def poll_device(self) -> None:
         log.debug('poll_device: start')
+        # While no source answers, double the time between polls, but poll at
+        # least twice per archive period so that a recovered device is noticed
+        # in time for the next archive record.
+        max_sleep = max(self.cfg.poll_interval, self.cfg.archive_interval // 2)
+        sleep_time = self.cfg.poll_interval
         while True:
             try:
                 log.debug('poll_device: calling get_concentrations.')
@@ -474,12 +704,178 @@ class DevicePoller:
                 log.error('poll_device exception: %s' % e)
                 weeutil.logger.log_traceback(log.critical, "    ****  ")
                 concentrations = None
-            log.debug('poll_device: concentrations: %s' % concentrations)
+            log.debug('poll_device: concentrations: %s', concentrations)
             if concentrations is not None:
-                with self.cfg.lock:
-                    self.cfg.concentrations = concentrations
-            log.debug('poll_device: Sleeping for %d seconds.' % self.cfg.poll_interval)
-            time.sleep(self.cfg.poll_interval)
+                self.cfg.concentrations = concentrations
+                sleep_time = self.cfg.poll_interval
+            else:
+                sleep_time = min(max_sleep, sleep_time * 2)
+            log.debug('poll_device: Sleeping for %d seconds.', sleep_time)
+            time.sleep(sleep_time)
+
+#             U.S. EPA PM2.5 AQI
+#
+#  AQI Category  AQI Value  24-hr PM2.5
+# Good             0 -  50    0.0 -  12.0
+# Moderate        51 - 100   12.1 -  35.4
+# USG            101 - 150   35.5 -  55.4
+# Unhealthy      151 - 200   55.5 - 150.4
+# Very Unhealthy 201 - 300  150.5 - 250.4
+# Hazardous      301 - 400  250.5 - 350.4
+# Hazardous      401 - 500  350.5 - 500.4
+#
+# Each entry is (pm_hi, pm_lo, pm_span, aqi_lo, aqi_span).  The spans are kept
+# exactly as the EPA formulas state them (rather than folded into a single
+# slope) so that rounding of values that land on .5 is unchanged.
+_AQI_BREAKPOINTS: Tuple[Tuple[float, float, float, float, float], ...] = (
+    ( 12.0,   0.0,  12.0,   0.0, 50.0), # Good
+    ( 35.4,  12.1,  23.3,  51.0, 49.0), # Moderate
+    ( 55.4,  35.5,  19.9, 101.0, 49.0), # Unhealthy for sensitive groups
+    (150.4,  55.5,  94.9, 151.0, 49.0), # Unhealthy
+    (250.4, 150.5,  99.9, 201.0, 99.0), # Very Unhealthy
+    (350.4, 250.5,  99.9, 301.0, 99.0), # Hazardous
+    (500.4, 350.5, 149.9, 401.0, 99.0), # Hazardous
+)
+# Upper bound of each segment, searched with bisect_left to pick the segment.
+_AQI_UPPERS: Tuple[float, ...] = tuple(bp[0] for bp in _AQI_BREAKPOINTS)
+# (pm_lo, pm_span, aqi_lo, aqi_span) for each segment.
+_AQI_SEGS: Tuple[Tuple[float, float, float, float], ...] = tuple(bp[1:] for bp in _AQI_BREAKPOINTS)
+_AQI_LAST_SEG = len(_AQI_SEGS) - 1
+
+@functools.lru_cache(maxsize=1024)
+def _compute_pm2_5_aqi_tenths(tenths: int) -> int:
+    """AQI for a PM2.5 concentration already truncated to tenths (i.e., 12.3 is 123).
+
+    Memoized since, at one decimal place, consecutive readings mostly repeat."""
+    x = tenths / 10
+
+    # Readings above the table are extrapolated along the last segment.
+    i = bisect_left(_AQI_UPPERS, x)
+    if i > _AQI_LAST_SEG:
+        i = _AQI_LAST_SEG
+    pm_lo, pm_span, aqi_lo, aqi_span = _AQI_SEGS[i]
+    return round((x - pm_lo) / pm_span * aqi_span + aqi_lo)
+
+# Highest AQI of each color band; anything above the last is maroon.
+_AQI_COLOR_THRESHOLDS: Tuple[int, ...] = (50, 100, 150, 200, 300)
+_AQI_COLORS: Tuple[int, ...] = (
+    0x008000, # Green
+    0xFFFF00, # Yellow
+    0xFF8C00, # Orange
+    0xFF0000, # Red
+    0x800080, # Purple
+    0x800000, # Maroon
+)
+
+# Number of rows read from the database at a time by _fetch_array.
+_FETCH_BATCH_SIZE = 8192
+
+def _fetch_array(db_manager, sql_str, sql_args):
+    """Run a query and return the result set as a 2-D float64 numpy array.
+
+    Rows are read from the cursor in batches, and each batch is converted to
+    numpy in one call, rather than yielding rows one at a time through genSql."""
+    batches = []
+    cursor = db_manager.connection.cursor()
+    try:
+        cursor.execute(sql_str, sql_args)
+        while True:
+            batch = list(itertools.islice(cursor, _FETCH_BATCH_SIZE))
+            if not batch:
+                break
+            batches.append(np.array(batch, dtype=np.float64))
+    finally:
+        cursor.close()
+    if not batches:
+        return np.empty((0, 0), dtype=np.float64)
+    if len(batches) == 1:
+        # The usual case (e.g., a day or a week of archive records); no copy needed.
+        return batches[0]
+    return np.concatenate(batches)
+
+if np is not None:
+    _AQI_UPPERS_ARRAY = np.array(_AQI_UPPERS, dtype=np.float64)
+    _AQI_SEGS_ARRAY = np.array(_AQI_SEGS, dtype=np.float64)
+    _AQI_COLOR_THRESHOLDS_ARRAY = np.array(_AQI_COLOR_THRESHOLDS, dtype=np.int64)
+    _AQI_COLORS_ARRAY = np.array(_AQI_COLORS, dtype=np.int64)
+
+_pm2_5_aqi_kernel = None
+_pm2_5_aqi_color_kernel = None
+if np is not None and numba is not None:
+    try:
+        # fastmath is not used as it could reorder the arithmetic and change the
+        # rounding of values that land on .5.
+        @numba.njit(cache=True)
+        def _pm2_5_aqi_value(pm2_5, uppers, segs):
+            """Compiled AQI.compute_pm2_5_aqi of a single value (inlined by the kernels below)."""
+            last = uppers.shape[0] - 1
+            x = np.trunc(pm2_5 * 10) / 10
+            seg = 0
+            while seg < last and x > uppers[seg]:
+                seg += 1
+            pm_lo, pm_span, aqi_lo, aqi_span = segs[seg, 0], segs[seg, 1], segs[seg, 2], segs[seg, 3]
+            return np.rint((x - pm_lo) / pm_span * aqi_span + aqi_lo)
+
+        @numba.njit(cache=True)
+        def _pm2_5_aqi_kernel(pm2_5, out, uppers, segs):
+            """Compiled AQI.compute_pm2_5_aqi over pm2_5, written to out (int64)."""
+            for i in range(pm2_5.shape[0]):
+                out[i] = _pm2_5_aqi_value(pm2_5[i], uppers, segs)
+
+        @numba.njit(cache=True)
+        def _pm2_5_aqi_color_kernel(pm2_5, out, uppers, segs, thresholds, colors):
+            """Compiled AQI.compute_pm2_5_aqi_color(AQI.compute_pm2_5_aqi()) over pm2_5,
+            written to out (int64), without materializing the intermediate AQI array."""
+            last = thresholds.shape[0]
+            for i in range(pm2_5.shape[0]):
+                aqi = _pm2_5_aqi_value(pm2_5[i], uppers, segs)
+                band = 0
+                while band < last and aqi > thresholds[band]:
+                    band += 1
+                out[i] = colors[band]
+    except Exception as e:
+        # numba is only an accelerator; e.g., when it can't find a writable
+        # cache directory, fall back to numpy rather than fail to load.
+        log.info('Not using numba (%s); AQI series are computed with numpy.', e)
+        _pm2_5_aqi_kernel = None
+        _pm2_5_aqi_color_kernel = None
+
+def _compute_pm2_5_aqi_array(pm2_5):
+    """Vectorized AQI.compute_pm2_5_aqi over a numpy array of PM2.5 values."""
+    if _pm2_5_aqi_kernel is not None:
+        out = np.empty(pm2_5.shape[0], dtype=np.int64)
+        _pm2_5_aqi_kernel(np.ascontiguousarray(pm2_5, dtype=np.float64), out,
+                          _AQI_UPPERS_ARRAY, _AQI_SEGS_ARRAY)
+        return out
+    x = np.trunc(pm2_5 * 10) / 10
+    # side='left' matches bisect_left in _compute_pm2_5_aqi_tenths.
+    seg = np.minimum(np.searchsorted(_AQI_UPPERS_ARRAY, x, side='left'), _AQI_LAST_SEG)
+    pm_lo, pm_span, aqi_lo, aqi_span = _AQI_SEGS_ARRAY[seg].T
+    # np.rint, like round(), rounds halves to even.
+    return np.rint((x - pm_lo) / pm_span * aqi_span + aqi_lo).astype(np.int64)
+
+def _compute_pm2_5_aqi_color_array(pm2_5_aqi):
+    """Vectorized AQI.compute_pm2_5_aqi_color over a numpy array of AQI values."""
+    return _AQI_COLORS_ARRAY[np.searchsorted(_AQI_COLOR_THRESHOLDS_ARRAY, pm2_5_aqi, side='left')]
+
+def _compute_pm2_5_aqi_color_array_from_pm2_5(pm2_5):
+    """Vectorized AQI.compute_pm2_5_aqi_color(AQI.compute_pm2_5_aqi()) over a numpy
+    array of PM2.5 values."""
+    if _pm2_5_aqi_color_kernel is not None:
+        out = np.empty(pm2_5.shape[0], dtype=np.int64)
+        _pm2_5_aqi_color_kernel(np.ascontiguousarray(pm2_5, dtype=np.float64), out,
+                                _AQI_UPPERS_ARRAY, _AQI_SEGS_ARRAY,
+                                _AQI_COLOR_THRESHOLDS_ARRAY, _AQI_COLORS_ARRAY)
+        return out
+    return _compute_pm2_5_aqi_color_array(_compute_pm2_5_aqi_array(pm2_5))
+
+class CachedAggregate(NamedTuple):
+    timestamp      : float # When the aggregate was read from the database
+    value          : Any   # The pm2_5 aggregate (before conversion to AQI)
+    std_unit_system: Any
+
+# Expired entries are only purged once the aggregate cache grows past this size.
+_AGG_CACHE_PURGE_SIZE = 256
 
 class AQI(weewx.xtypes.XType):
     """
@@ -487,89 +883,78 @@ class AQI(weewx.xtypes.XType):
     the pm2_5 value.
     """
 
-    def __init__(self):
-        pass
-
+    def __init__(self, cache_ttl: int = 0):
+        # pm2_5 aggregates read by get_aggregate, keyed on (database, table,
+        # aggregate_type, start, stop).  Every obs_type is derived from the same
+        # pm2_5 aggregate, so a report asking for both pm2_5_aqi and
+        # pm2_5_aqi_color over a timespan issues one query.  Entries are used
+        # for cache_ttl seconds (0 disables caching).
+        self.cache_ttl = cache_ttl
+        self.agg_cache: Dict[Tuple, CachedAggregate] = {}
+        # agg_sql_dict with the table name filled in, by table name.
+        self.agg_sql_by_table: Dict[str, Dict[str, str]] = {}
+
+    def clear_cache(self) -> None:
+        self.agg_cache = {}
+
+    # AQI is a non-decreasing function of the PM2.5 concentration, so the first,
+    # last, min and max AQI are the AQI of the first, last, min and max pm2_5.
+    # The database aggregates pm2_5 and only the single result is converted.
+    # Note: avg is the AQI of the average concentration (as the EPA computes
+    # it), not the average of the AQIs.
+    # There is no sum: a sum of concentrations has no AQI, and a sum of AQIs
+    # is meaningless.
+    # Each statement takes (start, stop) as parameters.
     agg_sql_dict = {
-        'avg': "SELECT AVG(pm2_5), usUnits FROM %(table_name)s "
-               "WHERE dateTime > %(start)s AND dateTime <= %(stop)s AND pm2_5 IS NOT NULL",
-        'count': "SELECT COUNT(dateTime), usUnits FROM %(table_name)s "
-                 "WHERE dateTime > %(start)s AND dateTime <= %(stop)s AND pm2_5 IS NOT NULL",
+        'avg': "SELECT AVG(pm2_5), MIN(usUnits) FROM %(table_name)s "
+               "WHERE dateTime > ? AND dateTime <= ? AND pm2_5 IS NOT NULL",
+        'count': "SELECT COUNT(dateTime), MIN(usUnits) FROM %(table_name)s "
+                 "WHERE dateTime > ? AND dateTime <= ? AND pm2_5 IS NOT NULL",
         'first': "SELECT pm2_5, usUnits FROM %(table_name)s "
                  "WHERE dateTime = (SELECT MIN(dateTime) FROM %(table_name)s "
-                 "WHERE dateTime > %(start)s AND dateTime <= %(stop)s AND pm2_5 IS NOT NULL",
+                 "WHERE dateTime > ? AND dateTime <= ? AND pm2_5 IS NOT NULL)",
         'last': "SELECT pm2_5, usUnits FROM %(table_name)s "
                 "WHERE dateTime = (SELECT MAX(dateTime) FROM %(table_name)s "
-                "WHERE dateTime > %(start)s AND dateTime <= %(stop)s AND pm2_5 IS NOT NULL",
-        'min': "SELECT pm2_5, usUnits FROM %(table_name)s "
-               "WHERE dateTime > %(start)s AND dateTime <= %(stop)s AND pm2_5 IS NOT NULL "
-               "ORDER BY pm2_5 ASC LIMIT 1;",
-        'max': "SELECT pm2_5, usUnits FROM %(table_name)s "
-               "WHERE dateTime > %(start)s AND dateTime <= %(stop)s AND pm2_5 IS NOT NULL "
-               "ORDER BY pm2_5 DESC LIMIT 1;",
-        'sum': "SELECT SUM(pm2_5), usUnits FROM %(table_name)s "
-               "WHERE dateTime > %(start)s AND dateTime <= %(stop)s AND pm2_5 IS NOT NULL)",
+                "WHERE dateTime > ? AND dateTime <= ? AND pm2_5 IS NOT NULL)",
+        'min': "SELECT MIN(pm2_5), MIN(usUnits) FROM %(table_name)s "
+               "WHERE dateTime > ? AND dateTime <= ? AND pm2_5 IS NOT NULL",
+        'max': "SELECT MAX(pm2_5), MIN(usUnits) FROM %(table_name)s "
+               "WHERE dateTime > ? AND dateTime <= ? AND pm2_5 IS NOT NULL",
     }
 
     @staticmethod
     def compute_pm2_5_aqi(pm2_5):
-        #             U.S. EPA PM2.5 AQI
-        #
-        #  AQI Category  AQI Value  24-hr PM2.5
-        # Good             0 -  50    0.0 -  12.0
-        # Moderate        51 - 100   12.1 -  35.4
-        # USG            101 - 150   35.5 -  55.4
-        # Unhealthy      151 - 200   55.5 - 150.4
-        # Very Unhealthy 201 - 300  150.5 - 250.4
-        # Hazardous      301 - 400  250.5 - 350.4
-        # Hazardous      401 - 500  350.5 - 500.4
-
         if pm2_5 is None:
             return None
 
         # The EPA standard for AQI says to truncate PM2.5 to one decimal place.
         # See https://www3.epa.gov/airnow/aqi-technical-assistance-document-sept2018.pdf
-        x = math.trunc(pm2_5 * 10) / 10
-
-        if x <= 12.0: # Good
-            return round(x / 12.0 * 50)
-        elif x <= 35.4: # Moderate
-            return round((x - 12.1) / 23.3 * 49.0 + 51.0)
-        elif x <= 55.4: # Unhealthy for senstive
-            return round((x - 35.5) / 19.9 * 49.0 + 101.0)
-        elif x <= 150.4: # Unhealthy
-            return round((x - 55.5) / 94.9 * 49.0 + 151.0)
-        elif x <= 250.4: # Very Unhealthy
-            return round((x - 150.5) / 99.9 * 99.0 + 201.0)
-        elif x <= 350.4: # Hazardous
-            return round((x - 250.5) / 99.9 * 99.0 + 301.0)
-        else: # Hazardous
-            return round((x - 350.5) / 149.9 * 99.0 + 401.0)
+        return _compute_pm2_5_aqi_tenths(int(pm2_5 * 10))
 
     @staticmethod
     def compute_pm2_5_aqi_color(pm2_5_aqi):
         if pm2_5_aqi is None:
             return None
 
-        if pm2_5_aqi <= 50:
-            return 128 << 8                 # Green
-        elif pm2_5_aqi <= 100:
-            return (255 << 16) + (255 << 8) # Yellow
-        elif pm2_5_aqi <=  150:
-            return (255 << 16) + (140 << 8) # Orange
-        elif pm2_5_aqi <= 200:
-            return 255 << 16                # Red
-        elif pm2_5_aqi <= 300:
-            return (128 << 16) + 128        # Purple
-        else:
-            return 128 << 16                # Maroon
+        return _AQI_COLORS[bisect_left(_AQI_COLOR_THRESHOLDS, pm2_5_aqi)]
+
+    # Maps each observation type this XType provides to the function that
+    # computes it from pm2_5.
+    _DISPATCH: Dict[str, Callable[[float], Any]] = {
+        'pm2_5_aqi'      : compute_pm2_5_aqi.__func__,
+        'pm2_5_aqi_color': lambda pm2_5: AQI.compute_pm2_5_aqi_color(AQI.compute_pm2_5_aqi(pm2_5)),
+    }
+    # The same, over a numpy array of pm2_5 values.
+    _ARRAY_DISPATCH: Dict[str, Callable[[Any], Any]] = {
+        'pm2_5_aqi'      : _compute_pm2_5_aqi_array,
+        'pm2_5_aqi_color': _compute_pm2_5_aqi_color_array_from_pm2_5,
+    }
 
     @staticmethod
     def get_scalar(obs_type, record, db_manager=None):
-        log.debug('get_scalar(%s)' % obs_type)
-        if obs_type not in [ 'pm2_5_aqi', 'pm2_5_aqi_color' ]:
+        log.debug('get_scalar(%s)', obs_type)
+        if obs_type not in AQI._DISPATCH:
             raise weewx.UnknownType(obs_type)
-        log.debug('get_scalar(%s)' % obs_type)
         if record is None:
             log.debug('get_scalar called where record is None.')
             raise weewx.CannotCalculate(obs_type)
@@ -583,16 +968,13 @@ class AQI(weewx.xtypes.XType):
             # Returning CannotCalculate causes exception in ImageGenerator, return UnknownType instead.
             # ERROR weewx.reportengine: Caught unrecoverable exception in generator 'weewx.imagegenerator.ImageGenerator'
             # Any archive catchup records will have None for pm2_5.
-            log.debug('get_scalar called where record[pm2_5] is None: %s.  Probably a catchup record.' %
-                timestamp_to_string(record['dateTime']))
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug('get_scalar called where record[pm2_5] is None: %s.  Probably a catchup record.',
+                    timestamp_to_string(record['dateTime']))
             raise weewx.UnknownType(obs_type)
         try:
-            pm2_5 = record['pm2_5']
-            if obs_type == 'pm2_5_aqi':
-                value = AQI.compute_pm2_5_aqi(pm2_5)
-            if obs_type == 'pm2_5_aqi_color':
-                value = AQI.compute_pm2_5_aqi_color(AQI.compute_pm2_5_aqi(pm2_5))
-            t, g = weewx.units.getStandardUnitType(record['usUnits'], obs_type)
+            value = AQI._DISPATCH[obs_type](record['pm2_5'])
+            t, g = _get_standard_unit_type(record['usUnits'], obs_type)
             # Form the ValueTuple and return it:
             return weewx.units.ValueTuple(value, t, g)
         except KeyError:
@@ -604,12 +986,13 @@ class AQI(weewx.xtypes.XType):
         """Get a series, possibly with aggregation.
         """
 
-        if obs_type not in [ 'pm2_5_aqi', 'pm2_5_aqi_color' ]:
+        if obs_type not in AQI._DISPATCH:
             raise weewx.UnknownType(obs_type)
 
-        log.debug('get_series(%s, %s, %s, aggregate:%s, aggregate_interval:%s)' % (
-            obs_type, timestamp_to_string(timespan.start), timestamp_to_string(
-            timespan.stop), aggregate_type, aggregate_interval))
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug('get_series(%s, %s, %s, aggregate:%s, aggregate_interval:%s)',
+                obs_type, timestamp_to_string(timespan.start), timestamp_to_string(
+                timespan.stop), aggregate_type, aggregate_interval)
 
         #  Prepare the lists that will hold the final results.
         start_vec = list()
@@ -628,35 +1011,41 @@ class AQI(weewx.xtypes.XType):
                       % db_manager.table_name
             std_unit_system = None
 
-            for record in db_manager.genSql(sql_str, timespan):
-                ts, unit_system, interval, pm2_5 = record
-                if std_unit_system:
-                    if std_unit_system != unit_system:
+            if np is not None:
+                table = _fetch_array(db_manager, sql_str, timespan)
+                if len(table):
+                    stop = table[:, 0].astype(np.int64)
+                    unit_col = table[:, 1]
+                    std_unit_system = int(unit_col[0])
+                    if (unit_col != std_unit_system).any():
+                        raise weewx.UnsupportedFeature(
+                            "Unit type cannot change within a time interval.")
+                    start = stop - table[:, 2].astype(np.int64) * 60
+                    values = AQI._ARRAY_DISPATCH[obs_type](table[:, 3])
+                    start_vec = start.tolist()
+                    stop_vec = stop.tolist()
+                    data_vec = values.tolist()
+            else:
+                rows = list(db_manager.genSql(sql_str, timespan))
+                if rows:
+                    ts_col, unit_col, interval_col, pm2_5_col = zip(*rows)
+                    std_unit_system = unit_col[0]
+                    if any(unit_system != std_unit_system for unit_system in unit_col):
                         raise weewx.UnsupportedFeature(
                             "Unit type cannot change within a time interval.")
-                else:
-                    std_unit_system = unit_system
-
-                if obs_type == 'pm2_5_aqi':
-                    value = AQI.compute_pm2_5_aqi(pm2_5)
-                if obs_type == 'pm2_5_aqi_color':
-                    value = AQI.compute_pm2_5_aqi_color(AQI.compute_pm2_5_aqi(pm2_5))
-                log.debug('get_series(%s): %s - %s - %s' % (obs_type,
-                    timestamp_to_string(ts - interval * 60),
-                    timestamp_to_string(ts), value))
-                start_vec.append(ts - interval * 60)
-                stop_vec.append(ts)
-                data_vec.append(value)
-
-            unit, unit_group = weewx.units.getStandardUnitType(std_unit_system, obs_type,
-                                                               aggregate_type)
+                    start_vec = [ts - interval * 60 for ts, interval in zip(ts_col, interval_col)]
+                    stop_vec = list(ts_col)
+                    compute = AQI._DISPATCH[obs_type]
+                    data_vec = [compute(pm2_5) for pm2_5 in pm2_5_col]
+            log.debug('get_series(%s): %d values', obs_type, len(data_vec))
+
+            unit, unit_group = _get_standard_unit_type(std_unit_system, obs_type, aggregate_type)
 
         return (ValueTuple(start_vec, 'unix_epoch', 'group_time'),
                 ValueTuple(stop_vec, 'unix_epoch', 'group_time'),
                 ValueTuple(data_vec, unit, unit_group))
 
-    @staticmethod
-    def get_aggregate(obs_type, timespan, aggregate_type, db_manager, **option_dict):
+    def get_aggregate(self, obs_type, timespan, aggregate_type, db_manager, **option_dict):
         """Returns an aggregation of pm2_5_aqi over a timespan by using the main archive
         table.
 
@@ -666,8 +1055,8 @@ class AQI(weewx.xtypes.XType):
         be done.
 
         aggregate_type: The type of aggregation to be done. For this function, must be 'avg',
-        'sum', 'count', 'first', 'last', 'min', or 'max'. Anything else will cause
-        weewx.UnknownAggregation to be raised.
+        'count', 'first', 'last', 'min', or 'max'. Anything else (including 'sum')
+        will cause weewx.UnknownAggregation to be raised.
 
         db_manager: An instance of weewx.manager.Manager or subclass.
 
@@ -675,45 +1064,68 @@ class AQI(weewx.xtypes.XType):
 
         returns: A ValueTuple containing the result.
         """
-        if obs_type not in [ 'pm2_5_aqi', 'pm2_5_aqi_color' ]:
+        if obs_type not in AQI._DISPATCH:
             raise weewx.UnknownType(obs_type)
 
-        log.debug('get_aggregate(%s, %s, %s, aggregate:%s)' % (
-            obs_type, timestamp_to_string(timespan.start),
-            timestamp_to_string(timespan.stop), aggregate_type))
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug('get_aggregate(%s, %s, %s, aggregate:%s)',
+                obs_type, timestamp_to_string(timespan.start),
+                timestamp_to_string(timespan.stop), aggregate_type)
 
         aggregate_type = aggregate_type.lower()
 
         # Raise exception if we don't know about this type of aggregation
-        if aggregate_type not in list(AQI.agg_sql_dict.keys()):
+        if aggregate_type not in AQI.agg_sql_dict:
             raise weewx.UnknownAggregation(aggregate_type)
 
-        # Form the interpolation dictionary
-        interpolation_dict = {
-            'start': timespan.start,
-            'stop': timespan.stop,
-            'table_name': db_manager.table_name
-        }
+        value, std_unit_system = self.get_pm2_5_aggregate(timespan, aggregate_type, db_manager)
+
+        # A count is a number of records, not a concentration.
+        if value is not None and aggregate_type != 'count':
+            value = AQI._DISPATCH[obs_type](value)
+        t, g = _get_standard_unit_type(std_unit_system, obs_type, aggregate_type)
+        # Form the ValueTuple and return it:
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug('get_aggregate(%s, %s, %s, aggregate:%s, returning %s)',
+                obs_type, timestamp_to_string(timespan.start), timestamp_to_string(timespan.stop),
+                aggregate_type, value)
+        return weewx.units.ValueTuple(value, t, g)
 
-        select_stmt = AQI.agg_sql_dict[aggregate_type] % interpolation_dict
-        row = db_manager.getSql(select_stmt)
+    def get_agg_sql(self, aggregate_type: str, table_name: str) -> str:
+        """Returns the statement for aggregate_type over table_name.  The
+        statements for a table are formatted the first time it is queried."""
+        statements = self.agg_sql_by_table.get(table_name)
+        if statements is None:
+            statements = {agg: sql % {'table_name': table_name}
+                          for agg, sql in AQI.agg_sql_dict.items()}
+            self.agg_sql_by_table[table_name] = statements
+        return statements[aggregate_type]
+
+    def get_pm2_5_aggregate(self, timespan, aggregate_type, db_manager) -> Tuple[Any, Any]:
+        """Returns (value, std_unit_system) of the pm2_5 aggregate over timespan,
+        from the cache if a fresh enough entry is present."""
+        key = (db_manager.database_name, db_manager.table_name, aggregate_type,
+               timespan.start, timespan.stop)
+        now = time.time()
+        cached = self.agg_cache.get(key)
+        if cached is not None and now - cached.timestamp < self.cache_ttl:
+            return cached.value, cached.std_unit_system
+
+        select_stmt = self.get_agg_sql(aggregate_type, db_manager.table_name)
+        row = db_manager.getSql(select_stmt, (timespan.start, timespan.stop))
         if row:
             value, std_unit_system = row
         else:
             value = None
             std_unit_system = None
+        log.debug('get_pm2_5_aggregate(select_stmt: %s, returning %s)', select_stmt, value)
 
-        if value is not None:
-            if obs_type == 'pm2_5_aqi':
-                value = AQI.compute_pm2_5_aqi(value)
-            if obs_type == 'pm2_5_aqi_color':
-                value = AQI.compute_pm2_5_aqi_color(AQI.compute_pm2_5_aqi(value))
-        t, g = weewx.units.getStandardUnitType(std_unit_system, obs_type, aggregate_type)
-        # Form the ValueTuple and return it:
-        log.debug('get_aggregate(%s, %s, %s, aggregate:%s, select_stmt: %s, returning %s)' % (
-            obs_type, timestamp_to_string(timespan.start), timestamp_to_string(timespan.stop),
-            aggregate_type, select_stmt, value))
-        return weewx.units.ValueTuple(value, t, g)
+        if self.cache_ttl > 0:
+            if len(self.agg_cache) >= _AGG_CACHE_PURGE_SIZE:
+                self.agg_cache = {k: v for k, v in self.agg_cache.items()
+                                  if now - v.timestamp < self.cache_ttl}
+            self.agg_cache[key] = CachedAggregate(now, value, std_unit_system)
+        return value, std_unit_system
 
 if __name__ == "__main__":
     usage = """%prog [options] [--help] [--debug]"""
@@ -744,15 +1156,13 @@ if __name__ == "__main__":
     def test_extension(hostname, port):
         sources = [Source({'Sensor1': { 'enable': True, 'hostname': hostname, 'port': port, 'timeout': 2}}, 'Sensor1')]
         cfg = Configuration(
-            lock             = threading.Lock(),
             concentrations   = None,
             archive_interval = 300,
             archive_delay    = 15,
             poll_interval    = 5,
             sources          = sources)
         while True:
-            with cfg.lock:
-                cfg.concentrations = get_concentrations(cfg)
+            cfg.concentrations = get_concentrations(cfg)
             print('%s:%d concentrations: %s' % (cfg.sources[0].hostname, cfg.sources[0].port, cfg.concentrations))
             packet = {}
             AirLink.fill_in_packet(cfg, packet)
@@ -3,11 +3,20 @@
 #
 """Test processing packets."""
 
+import importlib.util
 import json
 import logging
+import os
+import tempfile
+import threading
+import time
 import unittest
 
 import weeutil.logger
+import weeutil.weeutil
+import weewx
+import weewx.manager
+import weewx.schemas.wview_extended
 
 import user.airlink
 
@@ -124,6 +133,108 @@ class AirLinkTests(unittest.TestCase):
         self.assertEqual(user.airlink.AQI.compute_pm2_5_aqi_color(450), 128 << 16)
         self.assertEqual(user.airlink.AQI.compute_pm2_5_aqi_color(500), 128 << 16)
 
+    @unittest.skipIf(user.airlink.np is None, 'numpy is not installed')
+    def test_compute_pm2_5_aqi_array(self):
+        np = user.airlink.np
+
+        # The vectorized versions must agree with the scalar versions.
+        pm2_5 = [x / 100 for x in range(60000)]
+        aqi = user.airlink._compute_pm2_5_aqi_array(np.asarray(pm2_5))
+        self.assertEqual(aqi.tolist(), [user.airlink.AQI.compute_pm2_5_aqi(x) for x in pm2_5])
+
+        pm2_5_aqi = list(range(600))
+        colors = user.airlink._compute_pm2_5_aqi_color_array(np.asarray(pm2_5_aqi))
+        self.assertEqual(colors.tolist(), [user.airlink.AQI.compute_pm2_5_aqi_color(x) for x in pm2_5_aqi])
+
+        colors = user.airlink._compute_pm2_5_aqi_color_array_from_pm2_5(np.asarray(pm2_5))
+        self.assertEqual(colors.tolist(), [user.airlink.AQI.compute_pm2_5_aqi_color(
+            user.airlink.AQI.compute_pm2_5_aqi(x)) for x in pm2_5])
+
+    @unittest.skipIf(user.airlink.np is None, 'numpy is not installed')
+    def test_compute_pm2_5_aqi_array_without_numba(self):
+        np = user.airlink.np
+
+        # Exercise the pure numpy versions even when numba is installed.
+        aqi_kernel = user.airlink._pm2_5_aqi_kernel
+        color_kernel = user.airlink._pm2_5_aqi_color_kernel
+        user.airlink._pm2_5_aqi_kernel = None
+        user.airlink._pm2_5_aqi_color_kernel = None
+        try:
+            pm2_5 = [x / 100 for x in range(60000)]
+            aqi = user.airlink._compute_pm2_5_aqi_array(np.asarray(pm2_5))
+            self.assertEqual(aqi.tolist(), [user.airlink.AQI.compute_pm2_5_aqi(x) for x in pm2_5])
+            colors = user.airlink._compute_pm2_5_aqi_color_array_from_pm2_5(np.asarray(pm2_5))
+            self.assertEqual(colors.tolist(), [user.airlink.AQI.compute_pm2_5_aqi_color(
+                user.airlink.AQI.compute_pm2_5_aqi(x)) for x in pm2_5])
+        finally:
+            user.airlink._pm2_5_aqi_kernel = aqi_kernel
+            user.airlink._pm2_5_aqi_color_kernel = color_kernel
+
+    @unittest.skipIf(user.airlink.numba is None, 'numba is not installed')
+    def test_import_when_numba_fails(self):
+        # e.g., numba raises RuntimeError when it has no writable cache directory.
+        def failing_njit(*args, **kwargs):
+            raise RuntimeError('cannot cache function: no locator available')
+        numba = user.airlink.numba
+        njit = numba.njit
+        numba.njit = failing_njit
+        try:
+            spec = importlib.util.spec_from_file_location('airlink_without_numba', user.airlink.__file__)
+            airlink = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(airlink)
+        finally:
+            numba.njit = njit
+        self.assertIsNone(airlink._pm2_5_aqi_kernel)
+        self.assertIsNone(airlink._pm2_5_aqi_color_kernel)
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            db_dict = {'database_name': os.path.join(tmpdir, 'airlink.sdb'), 'driver': 'weedb.sqlite'}
+            with weewx.manager.Manager.open_with_create(
+                    db_dict, schema=weewx.schemas.wview_extended.schema) as db_manager:
+                pm2_5 = [(i * 1.37) % 600 for i in range(100)]
+                db_manager.addRecord([{
+                    'dateTime': 1601491800 + 300 * i, 'usUnits': weewx.US, 'interval': 5,
+                    'pm2_5': pm2_5[i]} for i in range(100)])
+                timespan = weeutil.weeutil.TimeSpan(1601491500, 1601491800 + 300 * 100)
+                _, _, data_vec = airlink.AQI.get_series('pm2_5_aqi', timespan, db_manager)
+                self.assertEqual(data_vec.value, [user.airlink.AQI.compute_pm2_5_aqi(x) for x in pm2_5])
+                _, _, data_vec = airlink.AQI.get_series('pm2_5_aqi_color', timespan, db_manager)
+                self.assertEqual(data_vec.value, [user.airlink.AQI.compute_pm2_5_aqi_color(
+                    user.airlink.AQI.compute_pm2_5_aqi(x)) for x in pm2_5])
+
+    @unittest.skipIf(user.airlink.np is None, 'numpy is not installed')
+    def test_get_series(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            db_dict = {'database_name': os.path.join(tmpdir, 'airlink.sdb'), 'driver': 'weedb.sqlite'}
+            with weewx.manager.Manager.open_with_create(
+                    db_dict, schema=weewx.schemas.wview_extended.schema) as db_manager:
+                # More records than one fetch batch, with some missing pm2_5.
+                count = user.airlink._FETCH_BATCH_SIZE + 500
+                db_manager.addRecord([{
+                    'dateTime': 1601491800 + 300 * i, 'usUnits': weewx.US, 'interval': 5,
+                    'pm2_5': None if i % 7 == 0 else (i * 1.37) % 600} for i in range(count)])
+                timespans = [
+                    weeutil.weeutil.TimeSpan(1601491500, 1601491800 + 300 * count), # All
+                    weeutil.weeutil.TimeSpan(1601491500, 1601491800 + 300 * 100),   # One batch
+                    weeutil.weeutil.TimeSpan(1500000000, 1500000300),               # Empty
+                ]
+                np = user.airlink.np
+                for obs_type in ('pm2_5_aqi', 'pm2_5_aqi_color'):
+                    for timespan in timespans:
+                        with_np = user.airlink.AQI.get_series(obs_type, timespan, db_manager)
+                        user.airlink.np = None
+                        try:
+                            without_np = user.airlink.AQI.get_series(obs_type, timespan, db_manager)
+                        finally:
+                            user.airlink.np = np
+                        self.assertEqual(with_np, without_np)
+                    # The last timespan has no records.
+                    start_vec, stop_vec, data_vec = with_np
+                    self.assertEqual(data_vec.value, [])
+                all_series = user.airlink.AQI.get_series('pm2_5_aqi', timespans[0], db_manager)
+                self.assertEqual(len(all_series[2].value), count - (count + 6) // 7)
+                self.assertEqual(all_series[1].value[0] - all_series[0].value[0], 300)
+
     def test_is_sane(self):
         minimal= ('{ \
                   "data": { \
@@ -270,6 +381,236 @@ class AirLinkTests(unittest.TestCase):
         sane, msg = user.airlink.is_sane(j)
         assert(not sane)
         assert(msg == 'Missing or malformed "pm_1" field')
+        # JSON true is not an integer, though Python's bool is an int.
+        j = json.loads(minimal.replace('"pm_1_last": 4', '"pm_1_last": true'))
+        sane, _ = user.airlink.is_sane(j)
+        assert(not sane)
+
+    @unittest.skipIf(user.airlink.fastjsonschema is None, 'fastjsonschema is not installed')
+    def test_is_sane_with_and_without_schema(self):
+        reading = ('{"data": {"did": "001D0A100214", "name": "airlink", "ts": 1601491799, \
+            "conditions": [{"lsid": 349506, "data_structure_type": 6, "temp": 71.9, \
+            "hum": 70.1, "dew_point": 61.6, "wet_bulb": 64.5, "heat_index": 72.5, \
+            "pm_1_last": 15, "pm_2p5_last": 24, "pm_10_last": 27, "pm_1": 14.1, \
+            "pm_2p5": 22.9, "pm_2p5_last_1_hour": null, "pm_2p5_last_3_hours": null, \
+            "pm_2p5_last_24_hours": null, "pm_2p5_nowcast": 20.3, "pm_10": 25.3, \
+            "pm_10_last_1_hour": null, "pm_10_last_3_hours": null, \
+            "pm_10_last_24_hours": null, "pm_10_nowcast": 24.8, \
+            "last_report_time": 1601491799, "pct_pm_data_last_1_hour": 100, \
+            "pct_pm_data_last_3_hours": 100, "pct_pm_data_nowcast": 100, \
+            "pct_pm_data_last_24_hours": 100}]}, "error": null}')
+        variants = [
+            ('"ts": 1601491799', '"ts": 1601491799'),
+            ('"ts": 1601491799', '"ts": 1601491799.0'),
+            ('"ts": 1601491799', '"ts": true'),
+            ('"last_report_time": 1601491799', '"last_report_time": 1601491799.0'),
+            ('"lsid": 349506', '"lsid": null'),
+            ('"lsid": 349506', '"lsid": false'),
+            ('"data_structure_type": 6', '"data_structure_type": 6.0'),
+            ('"data_structure_type": 6', '"data_structure_type": 5'),
+            ('"temp": 71.9', '"temp": 72'),
+            ('"temp": 71.9', '"temp": true'),
+            ('"temp": 71.9', '"temp": null'),
+            ('"pm_1": 14.1', '"pm_1": null'),
+            ('"pm_1": 14.1', '"pm_1": "14.1"'),
+            ('"pm_2p5_last": 24', '"pm_2p5_last": 24.5'),
+            ('"name": "airlink"', '"name": 7'),
+            ('"error": null', '"error": "busy"'),
+            ('"heat_index": 72.5, ', ''),
+        ]
+        validator = user.airlink._validate_sanity
+        try:
+            for old, new in variants:
+                j = json.loads(reading.replace(old, new))
+                user.airlink._validate_sanity = validator
+                with_schema, _ = user.airlink.is_sane(j)
+                user.airlink._validate_sanity = None
+                without_schema, _ = user.airlink.is_sane(j)
+                self.assertEqual(with_schema, without_schema, new)
+        finally:
+            user.airlink._validate_sanity = validator
+
+    def test_populate_record(self):
+        # heat_index is missing.
+        j = json.loads('{"data": {"did": "001D0A100214", \
+            "name": "airlink", "ts": 1601491799, "conditions": [{"lsid": 349506, \
+            "data_structure_type": 6, "temp": 71.9, "hum": 70.1, "dew_point": 61.6, \
+            "wet_bulb": 64.5, "pm_1_last": 15, "pm_2p5_last": 24, \
+            "pm_10_last": 27, "pm_1": 14.1, "pm_2p5": 22.9, "pm_2p5_last_1_hour": null, \
+            "pm_2p5_last_3_hours": null, "pm_2p5_last_24_hours": null, \
+            "pm_2p5_nowcast": 20.3, "pm_10": 25.3, "pm_10_last_1_hour": null, \
+            "pm_10_last_3_hours": null, "pm_10_last_24_hours": null, \
+            "pm_10_nowcast": 24.8, "last_report_time": 1601491799, \
+            "pct_pm_data_last_1_hour": 100, "pct_pm_data_last_3_hours": 100, \
+            "pct_pm_data_nowcast": 100, "pct_pm_data_last_24_hours": 100 \
+            }]}, "error": null}')
+        record = user.airlink.populate_record(1601491799, j)
+        self.assertEqual(record['dateTime'], 1601491799)
+        self.assertEqual(record['usUnits'], user.airlink.weewx.US)
+        self.assertEqual(record['pm1_0'], 15)
+        self.assertEqual(record['pm2_5'], 24)
+        self.assertEqual(record['pm10_0'], 27)
+        self.assertEqual(record['pm_2p5'], 22.9)
+        self.assertEqual(record['pm_10_nowcast'], 24.8)
+        self.assertIsNone(record['pm_2p5_last_1_hour'])
+        self.assertIsNone(record['heat_index'])
+
+    def test_get_aggregate_cache(self):
+        class FakeManager:
+            database_name = 'weewx.sdb'
+            table_name = 'archive'
+            queries = 0
+            def getSql(self, sql, sqlargs=()):
+                self.queries += 1
+                return (20.3, 1)
+        db_manager = FakeManager()
+        timespan = weeutil.weeutil.TimeSpan(1601491500, 1601491800)
+        aqi = user.airlink.AQI(300)
+        self.assertEqual(aqi.get_aggregate('pm2_5_aqi', timespan, 'avg', db_manager)[0], 68)
+        self.assertEqual(aqi.get_aggregate('pm2_5_aqi_color', timespan, 'avg', db_manager)[0], 0xFFFF00)
+        self.assertEqual(db_manager.queries, 1)
+        aqi.clear_cache()
+        self.assertEqual(aqi.get_aggregate('pm2_5_aqi', timespan, 'avg', db_manager)[0], 68)
+        self.assertEqual(db_manager.queries, 2)
+        # A sum of concentrations (or of AQIs) is not an AQI.
+        with self.assertRaises(user.airlink.weewx.UnknownAggregation):
+            aqi.get_aggregate('pm2_5_aqi', timespan, 'sum', db_manager)
+
+    def test_collect_data_conditional_get(self):
+        now = int(time.time())
+        reading = {"data": {"did": "001D0A100214", "name": "airlink", "ts": now - 100,
+            "conditions": [{"lsid": 349506, "data_structure_type": 6, "temp": 71.9,
+            "hum": 70.1, "dew_point": 61.6, "wet_bulb": 64.5, "heat_index": 72.5,
+            "pm_1_last": 15, "pm_2p5_last": 24, "pm_10_last": 27, "pm_1": 14.1,
+            "pm_2p5": 22.9, "pm_2p5_last_1_hour": None, "pm_2p5_last_3_hours": None,
+            "pm_2p5_last_24_hours": None, "pm_2p5_nowcast": 20.3, "pm_10": 25.3,
+            "pm_10_last_1_hour": None, "pm_10_last_3_hours": None,
+            "pm_10_last_24_hours": None, "pm_10_nowcast": 24.8,
+            "last_report_time": now - 100, "pct_pm_data_last_1_hour": 100,
+            "pct_pm_data_last_3_hours": 100, "pct_pm_data_nowcast": 100,
+            "pct_pm_data_last_24_hours": 100}]}, "error": None}
+
+        class FakeResponse:
+            def __init__(self, status_code, headers, content=b''):
+                self.status_code = status_code
+                self.headers = headers
+                self.content = content
+            def raise_for_status(self):
+                pass
+
+        class FakeSession:
+            def __init__(self):
+                self.responses = []
+                self.request_headers = []
+            def get(self, url, headers=None, timeout=None):
+                self.request_headers.append(headers)
+                return self.responses.pop(0)
+
+        session = FakeSession()
+        saved_session = user.airlink._session
+        user.airlink._session = session
+        user.airlink._conditional_get_cache.clear()
+        try:
+            # A 200 with an ETag is cached.
+            session.responses.append(FakeResponse(200, {'ETag': '"1"'}, json.dumps(reading).encode()))
+            record = user.airlink.collect_data('airlink', 80, 10, 300)
+            self.assertEqual(record['dateTime'], now - 100)
+            self.assertEqual(record['pm2_5'], 24)
+            self.assertIsNone(session.request_headers[0])
+
+            # The next request is conditional, and a 304 returns the cached reading.
+            session.responses.append(FakeResponse(304, {'ETag': '"1"'}))
+            self.assertEqual(user.airlink.collect_data('airlink', 80, 10, 300), record)
+            self.assertEqual(session.request_headers[1], {'If-None-Match': '"1"'})
+
+            # A cached reading older than archive_interval is still rejected.
+            session.responses.append(FakeResponse(304, {'ETag': '"1"'}))
+            self.assertIsNone(user.airlink.collect_data('airlink', 80, 10, 60))
+            self.assertEqual(session.request_headers[2], {'If-None-Match': '"1"'})
+        finally:
+            user.airlink._session = saved_session
+            user.airlink._conditional_get_cache.clear()
+
+    def test_get_concentrations_source_priority(self):
+        def make_concentrations(ts):
+            return user.airlink.Concentrations(ts, 1, 2, 3, 1.0, 2.0, 3.0, 2.0, 3.0, 50.0, 70.0)
+
+        # hostname -> reading (None for no reading).  A source whose hostname
+        # is in hung doesn't answer until the event is set.
+        readings = {}
+        hung = {}
+        calls = []
+        def fake_get_concentrations_from_source(source, archive_interval):
+            calls.append(source.hostname)
+            if source.hostname in hung:
+                hung[source.hostname].wait(10)
+            return readings[source.hostname]
+
+        config_dict = {
+            'Sensor1': {'enable': 'true', 'hostname': 'primary'},
+            'Sensor2': {'enable': 'true', 'hostname': 'backup1'},
+            'Sensor3': {'enable': 'true', 'hostname': 'backup2'}}
+        cfg = user.airlink.Configuration(
+            concentrations   = None,
+            archive_interval = 300,
+            archive_delay    = 15,
+            poll_interval    = 5,
+            sources          = user.airlink.AirLink.configure_sources(config_dict))
+
+        saved = user.airlink.get_concentrations_from_source
+        user.airlink.get_concentrations_from_source = fake_get_concentrations_from_source
+        try:
+            # A healthy primary is used, and dead backups are never contacted.
+            readings.update(primary=make_concentrations(1), backup1=None, backup2=None)
+            hung['backup1'] = threading.Event()
+            for _ in range(3):
+                self.assertEqual(user.airlink.get_concentrations(cfg).timestamp, 1)
+            self.assertEqual(calls, ['primary'] * 3)
+            del hung['backup1']
+
+            # When the primary fails, the first backup in configured order wins,
+            # even if a lower priority backup answers sooner.
+            calls.clear()
+            readings.update(primary=None, backup1=make_concentrations(2), backup2=make_concentrations(3))
+            hung['backup1'] = threading.Event()
+            threading.Timer(0.2, hung['backup1'].set).start()
+            self.assertEqual(user.airlink.get_concentrations(cfg).timestamp, 2)
+            self.assertEqual(sorted(calls), ['backup1', 'backup2', 'primary'])
+            del hung['backup1']
+
+            # A backup that hasn't answered an earlier poll isn't asked again.
+            calls.clear()
+            hung['backup2'] = threading.Event()
+            for _ in range(3):
+                self.assertEqual(user.airlink.get_concentrations(cfg).timestamp, 2)
+            hung['backup2'].set()
+            user.airlink._backup_futures[cfg.sources[2]].result(10)
+            self.assertEqual(calls.count('backup2'), 1)
+            self.assertEqual(calls.count('backup1'), 3)
+
+            # Once it has answered, it is asked again.
+            self.assertEqual(user.airlink.get_concentrations(cfg).timestamp, 2)
+            self.assertEqual(calls.count('backup2'), 2)
+
+            # No source has a reading.
+            readings.update(backup1=None, backup2=None)
+            self.assertIsNone(user.airlink.get_concentrations(cfg))
+        finally:
+            for event in hung.values():
+                event.set()
+            user.airlink.get_concentrations_from_source = saved
+            user.airlink._shutdown_executor()
+
+    def test_configure_sources(self):
+        config_dict = {
+            'poll_interval': '5',
+            'Sensor10': {'enable': 'true', 'hostname': 'ten'},
+            'Sensor3' : {'enable': 'false', 'hostname': 'three'},
+            'Sensor1' : {'enable': 'true', 'hostname': 'one'},
+            'Sensorx' : {'enable': 'true', 'hostname': 'bogus'}}
+        sources = user.airlink.AirLink.configure_sources(config_dict)
+        self.assertEqual([s.hostname for s in sources], ['one', 'three', 'ten'])
+        self.assertEqual([s.enable for s in sources], [True, False, True])
 
 if __name__ == '__main__':
     unittest.main()